@@ -1,8 +1,18 @@
+import asyncio
 import os
+import pickle
 import chromadb
+import httpx
+import numpy as np
+from collections import OrderedDict
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core import QueryBundle, StorageContext, VectorStoreIndex
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 from llama_index.vector_stores.chroma import ChromaVectorStore
@@ -15,6 +25,10 @@ load_dotenv()
 # --- Configuration ---
 CHROMA_DB_PATH = "chroma_db"
 COLLECTION_NAME = "tds_virtual_ta_collection"
+# Marker written after the first successful start so later boots (each uvicorn
+# worker pays this) can open the collection directly instead of probing the
+# get-or-create path.
+ENGINE_META_PATH = ".engine_meta"
 
 # Ensure OPENAI_API_KEY is set
 if not os.getenv("OPENAI_API_KEY"):
@@ -28,7 +42,8 @@ if not os.getenv("OPENAI_BASE_URL"):
 app = FastAPI(
     title="Virtual TA API",
     description="An API for a Virtual Teaching Assistant powered by LlamaIndex and OpenAI, providing answers based on course content and Discourse forum data.",
-    version="0.1.0"
+    version="0.1.0",
+    default_response_class=ORJSONResponse # C-based serializer; faster than stdlib json per response
 )
 
 # --- ADDED CORS MIDDLEWARE HERE ---
@@ -64,9 +79,181 @@ class QueryResponse(BaseModel):
     links: list[SourceLink]
 
 
-# --- Global Variable for Query Engine ---
-# This will hold our RAG query engine, initialized once on startup.
+# --- Global Variables for Query Engine and Embedding Model ---
+# These hold our RAG query engine and embedding model, initialized once on startup.
 query_engine = None
+embed_model = None
+
+# --- In-Process Query Caches ---
+# Hot questions skip the embed + vector search + LLM round trip entirely.
+# The exact cache is keyed on the normalized question text; the semantic cache
+# keeps recent (query embedding, response) pairs so near-identical phrasings
+# (cosine similarity > 0.97) also hit.
+CACHE_MAX_ENTRIES = 1024
+SEMANTIC_CACHE_MAX_ENTRIES = 128
+SEMANTIC_SIMILARITY_THRESHOLD = 0.97
+
+exact_cache = OrderedDict() # normalized question -> QueryResponse
+semantic_cache = OrderedDict() # normalized question -> (unit embedding, QueryResponse)
+
+
+def cache_response(cache_key, query_embedding, response):
+    """
+    Stores a response in both caches, evicting least-recently-used entries.
+    """
+    exact_cache[cache_key] = response
+    exact_cache.move_to_end(cache_key)
+    while len(exact_cache) > CACHE_MAX_ENTRIES:
+        exact_cache.popitem(last=False)
+
+    if query_embedding is not None:
+        semantic_cache[cache_key] = (query_embedding, response)
+        semantic_cache.move_to_end(cache_key)
+        while len(semantic_cache) > SEMANTIC_CACHE_MAX_ENTRIES:
+            semantic_cache.popitem(last=False)
+
+
+def find_semantic_hit(query_embedding):
+    """
+    Returns a cached response whose query embedding is nearly identical to the
+    given unit embedding (cosine > SEMANTIC_SIMILARITY_THRESHOLD), or None.
+    """
+    if not semantic_cache:
+        return None
+    entries = list(semantic_cache.values())
+    cached_matrix = np.stack([embedding for embedding, _ in entries])
+    scores = cached_matrix @ query_embedding
+    best = int(np.argmax(scores))
+    if scores[best] > SEMANTIC_SIMILARITY_THRESHOLD:
+        return entries[best][1]
+    return None
+
+# --- Shared HTTP Client for OpenAI Calls ---
+# A single persistent client keeps TLS connections alive across requests and
+# multiplexes them over HTTP/2, instead of paying a fresh handshake per call.
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+# --- Retrieval Tuning ---
+# Retrieve wide from HNSW (cheap) and forward only the strongest few chunks
+# to the LLM. The LLM input tokens dominate per-query latency and cost, so
+# trimming 5 chunks to 3 is the big lever here. No absolute similarity cutoff
+# is applied: the collection uses l2 space and ChromaVectorStore maps distance
+# to exp(-distance) scores, a scale on which any fixed threshold either does
+# nothing or throws away every candidate.
+RETRIEVAL_TOP_K = 20
+LLM_CONTEXT_TOP_N = 3
+
+
+class TopNPostprocessor(BaseNodePostprocessor):
+    """
+    Keeps only the top_n highest-scoring retrieved nodes.
+
+    When node and query embeddings are available, the rerank is one
+    vectorized cosine pass (a single matrix-vector product that dispatches to
+    BLAS SIMD kernels) instead of a per-node Python loop; otherwise it falls
+    back to sorting by the retriever's scores.
+    """
+    top_n: int = LLM_CONTEXT_TOP_N
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if len(nodes) <= self.top_n:
+            return nodes
+
+        if (
+            query_bundle is not None
+            and query_bundle.embedding is not None
+            and all(n.node.embedding is not None for n in nodes)
+        ):
+            node_matrix = np.asarray([n.node.embedding for n in nodes], dtype=np.float32)
+            node_matrix /= np.linalg.norm(node_matrix, axis=1, keepdims=True)
+            query_vector = np.asarray(query_bundle.embedding, dtype=np.float32)
+            query_vector /= np.linalg.norm(query_vector)
+
+            scores = node_matrix @ query_vector # One SGEMV for all nodes
+            keep = np.argpartition(-scores, self.top_n)[:self.top_n]
+            keep = keep[np.argsort(-scores[keep])]
+            return [NodeWithScore(node=nodes[i].node, score=float(scores[i])) for i in keep]
+
+        return sorted(nodes, key=lambda n: n.score or 0.0, reverse=True)[:self.top_n]
+
+
+class ThreadOffloadRetriever(VectorIndexRetriever):
+    """
+    Runs retrieval in a worker thread instead of on the event loop.
+
+    Chroma's HNSW search is a synchronous C call even on the engine's async
+    path; offloading it with asyncio.to_thread lets the loop serve other
+    in-flight requests while the graph traversal runs.
+
+    When given the Chroma collection, it also fetches the candidates'
+    embeddings (which ChromaVectorStore.query does not return) and attaches
+    them to the nodes so TopNPostprocessor can run its vectorized rerank.
+    """
+
+    def __init__(self, *args, chroma_collection=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._chroma_collection = chroma_collection
+
+    def _retrieve_with_embeddings(self, query_bundle):
+        nodes = self._retrieve(query_bundle)
+        if self._chroma_collection is not None and nodes:
+            try:
+                result = self._chroma_collection.get(
+                    ids=[n.node.node_id for n in nodes],
+                    include=["embeddings"]
+                )
+                vectors = dict(zip(result["ids"], result["embeddings"]))
+                for n in nodes:
+                    vector = vectors.get(n.node.node_id)
+                    if vector is not None:
+                        n.node.embedding = [float(v) for v in vector]
+            except Exception as e:
+                # Rerank degrades to the retriever's own scores; non-fatal.
+                print(f"Warning: could not fetch candidate embeddings for rerank: {e}")
+        return nodes
+
+    async def _aretrieve(self, query_bundle):
+        return await asyncio.to_thread(self._retrieve_with_embeddings, query_bundle)
+
+
+# --- Helper Function for ChromaDB Client ---
+def get_chroma_client():
+    """
+    Returns a ChromaDB client. If CHROMA_SERVER_HOST is set, connects to a
+    running `chroma run --path chroma_db` server (same server the indexing
+    pipeline writes to); otherwise falls back to the embedded PersistentClient.
+    """
+    host = os.getenv("CHROMA_SERVER_HOST")
+    if host:
+        port = int(os.getenv("CHROMA_SERVER_PORT", "8000"))
+        print(f"Using ChromaDB HTTP server at {host}:{port}")
+        return chromadb.HttpClient(host=host, port=port)
+    return chromadb.PersistentClient(path=CHROMA_DB_PATH)
+
+
+def get_chroma_collection(db):
+    """
+    Returns the Chroma collection. A warm start (marker file present from a
+    previous boot) opens the collection directly with get_collection, skipping
+    the get-or-create probe; the first start creates it and writes the marker.
+    """
+    if os.path.exists(ENGINE_META_PATH):
+        try:
+            with open(ENGINE_META_PATH, "rb") as f:
+                engine_meta = pickle.load(f)
+            if engine_meta.get("coll_name") == COLLECTION_NAME:
+                return db.get_collection(COLLECTION_NAME)
+        except Exception as e:
+            print(f"Warning: could not use {ENGINE_META_PATH} ({e}); falling back to get_or_create.")
+
+    collection = db.get_or_create_collection(COLLECTION_NAME)
+    with open(ENGINE_META_PATH, "wb") as f:
+        pickle.dump({"coll_name": COLLECTION_NAME, "dim": 1536}, f)
+    return collection
+
 
 # --- Helper Function to Initialize RAG Engine ---
 def initialize_query_engine():
@@ -74,24 +261,27 @@ def initialize_query_engine():
     Initializes and returns the LlamaIndex query engine.
     This function will be called once when the FastAPI app starts up.
     """
+    global embed_model
     print(f"Connecting to ChromaDB at: {CHROMA_DB_PATH} and collection: {COLLECTION_NAME}")
     try:
         # Initialize ChromaDB client
-        db = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-        chroma_collection = db.get_or_create_collection(COLLECTION_NAME)
+        db = get_chroma_client()
+        chroma_collection = get_chroma_collection(db)
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
 
         # Configure the embedding model (same as used for indexing)
         embed_model = OpenAIEmbedding(
             model="text-embedding-ada-002",
-            api_base=os.getenv("OPENAI_BASE_URL")
+            api_base=os.getenv("OPENAI_BASE_URL"),
+            async_http_client=http_client # Reuse the shared connection pool
         )
 
         # Configure the LLM for response generation
         llm = OpenAI(
             model="gpt-3.5-turbo", # Or "gpt-4" if preferred and available
             api_base=os.getenv("OPENAI_BASE_URL"),
-            temperature=0.1
+            temperature=0.1,
+            async_http_client=http_client # Reuse the shared connection pool
         )
 
         # Load the index from the persisted storage
@@ -102,10 +292,19 @@ def initialize_query_engine():
         )
         print("VectorStoreIndex loaded.")
 
-        # Create a query engine
-        return index.as_query_engine(
+        # Create a query engine: wide-but-cheap vector retrieval, then a top-N
+        # cap so the LLM only sees the strongest chunks instead of the full
+        # retrieved context.
+        retriever = ThreadOffloadRetriever(
+            index=index,
+            similarity_top_k=RETRIEVAL_TOP_K,
+            chroma_collection=chroma_collection
+        )
+        return RetrieverQueryEngine.from_args(
+            retriever=retriever,
             llm=llm,
-            similarity_top_k=5, # Retrieve top 5 most relevant chunks
+            node_postprocessors=[TopNPostprocessor()],
+            use_async=True, # Enables aquery() so concurrent requests overlap at the OpenAI endpoint
             # You can add a custom prompt here if you want to refine the LLM's persona
             # e.g., system_prompt="You are a helpful Virtual TA for a Data Science course. Answer questions concisely and cite sources."
         )
@@ -130,11 +329,36 @@ async def startup_event():
         # Depending on your environment, you might want to exit here if core component fails
         # import sys
         # sys.exit(1)
+        return
+
+    # Warm the hot path before the first real request: one throwaway query
+    # pages the HNSW index arrays into memory and primes the TLS connection to
+    # the OpenAI endpoint, removing cold-start latency on the first user query.
+    try:
+        print("Warming up query engine...")
+        await query_engine.aquery("warmup")
+        print("Query engine warmup complete.")
+    except Exception as e:
+        # Warmup failure is non-fatal; the first real query just pays the cold cost.
+        print(f"Query engine warmup failed (non-fatal): {e}")
+
+
+# --- FastAPI Shutdown Event ---
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Closes the shared HTTP client when the FastAPI application shuts down.
+    """
+    await http_client.aclose()
 
 
 # --- API Endpoint Definition ---
 # --- CHANGED ENDPOINT FROM "/api/" TO "/" ---
-@app.post("/", response_model=QueryResponse)
+# response_model=None stops FastAPI from re-validating the returned object
+# against QueryResponse — that validation pass was exactly what the
+# model_construct calls below are meant to skip. The `responses` entry keeps
+# the schema in the OpenAPI docs.
+@app.post("/", response_model=None, responses={200: {"model": QueryResponse}})
 async def query_ta(request: QueryRequest):
     """
     Endpoint to ask a question to the Virtual TA.
@@ -146,9 +370,35 @@ async def query_ta(request: QueryRequest):
     if not question:
         raise HTTPException(status_code=400, detail="Question cannot be empty.")
 
+    # Exact-match cache: repeated questions return immediately.
+    cache_key = question.lower()
+    cached_response = exact_cache.get(cache_key)
+    if cached_response is not None:
+        exact_cache.move_to_end(cache_key)
+        return cached_response
+
     try:
-        # Query the RAG engine
-        response = query_engine.query(question)
+        # Semantic cache: embed the question once and compare against recent
+        # query embeddings; a near-identical phrasing short-circuits too.
+        raw_embedding = None
+        query_embedding = None
+        if embed_model is not None:
+            raw_embedding = await embed_model.aget_query_embedding(question)
+            query_embedding = np.asarray(raw_embedding, dtype=np.float32)
+            query_embedding /= np.linalg.norm(query_embedding)
+            semantic_hit = find_semantic_hit(query_embedding)
+            if semantic_hit is not None:
+                return semantic_hit
+
+        # Query the RAG engine asynchronously. The blocking query() call would hold
+        # the event loop for the whole embed + LLM round trip and serialize
+        # concurrent requests; aquery() lets in-flight requests overlap.
+        # Hand the embedding from the cache probe to the retriever via
+        # QueryBundle so it doesn't pay a second embed call for the same text.
+        if raw_embedding is not None:
+            response = await query_engine.aquery(QueryBundle(query_str=question, embedding=raw_embedding))
+        else:
+            response = await query_engine.aquery(question)
 
         # Extracting sources (for links)
         source_nodes = response.source_nodes
@@ -156,14 +406,19 @@ async def query_ta(request: QueryRequest):
         for node in source_nodes:
             metadata = node.metadata
             url = metadata.get('url')
-            # Prioritize 'title' from Markdown frontmatter, fallback to 'topic_title' for Discourse
-            # Also check for 'text' from the YAML schema if that's what's available
-            title = metadata.get('title') or metadata.get('topic_title') or metadata.get('text') or url or "No Title Available"
+            # 'display_title' is pre-resolved at ingest time (see process_data.py),
+            # so the hot path reads one key. The old fallback chain is kept only
+            # for indexes built before display_title existed.
+            title = metadata.get('display_title') or metadata.get('title') or metadata.get('topic_title') or metadata.get('text') or url or "No Title Available"
 
             if url:
-                links.append(SourceLink(url=url, title=title))
+                # model_construct skips Pydantic field validation; safe here
+                # because url and title are strings we just built ourselves.
+                links.append(SourceLink.model_construct(url=url, title=title))
 
-        return QueryResponse(answer=str(response), links=links)
+        result = QueryResponse.model_construct(answer=str(response), links=links)
+        cache_response(cache_key, query_embedding, result)
+        return result
 
     except Exception as e:
         print(f"Error during query processing: {e}")
@@ -172,4 +427,14 @@ async def query_ta(request: QueryRequest):
 # --- Root Endpoint (Optional, for basic health check) ---
 @app.get("/")
 async def root():
-    return {"message": "Virtual TA API is running. Go to /docs for API documentation."}
\ No newline at end of file
+    return {"message": "Virtual TA API is running. Go to /docs for API documentation."}
+
+
+# --- Local Entry Point ---
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools shave per-request event-loop and HTTP-parse overhead
+    # versus the default asyncio loop, which matters once requests overlap.
+    # If the embedding/LLM proxy exposes a concurrency knob (e.g. Ollama's
+    # OLLAMA_NUM_PARALLEL), raise it to match the in-flight request count.
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=2)
\ No newline at end of file
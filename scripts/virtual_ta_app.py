@@ -1,5 +1,7 @@
 import os
+import pickle
 import chromadb
+import httpx
 from llama_index.core import StorageContext, VectorStoreIndex, load_index_from_storage
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
@@ -12,6 +14,9 @@ load_dotenv()
 # --- Configuration ---
 CHROMA_DB_PATH = "chroma_db"
 COLLECTION_NAME = "tds_virtual_ta_collection"
+# Marker written after the first successful start so later sessions open the
+# collection directly instead of probing the get-or-create path.
+ENGINE_META_PATH = ".engine_meta"
 
 # Ensure OPENAI_API_KEY is set.
 if not os.getenv("OPENAI_API_KEY"):
@@ -21,6 +26,52 @@ if not os.getenv("OPENAI_BASE_URL"):
     print("Warning: OPENAI_BASE_URL environment variable not set. OpenAIEmbedding/OpenAI LLM will use default base URL.")
 
 
+# --- Shared HTTP Client for OpenAI Calls ---
+# One persistent client for the whole interactive session, so repeated
+# questions reuse warm TLS connections (multiplexed over HTTP/2) instead of
+# re-handshaking per request.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+
+def get_chroma_client():
+    """
+    Returns a ChromaDB client. If CHROMA_SERVER_HOST is set, connects to a
+    running `chroma run --path chroma_db` server (same server the indexing
+    pipeline writes to); otherwise falls back to the embedded PersistentClient.
+    """
+    host = os.getenv("CHROMA_SERVER_HOST")
+    if host:
+        port = int(os.getenv("CHROMA_SERVER_PORT", "8000"))
+        print(f"Using ChromaDB HTTP server at {host}:{port}")
+        return chromadb.HttpClient(host=host, port=port)
+    return chromadb.PersistentClient(path=CHROMA_DB_PATH)
+
+
+def get_chroma_collection(db):
+    """
+    Returns the Chroma collection. A warm start (marker file present from a
+    previous session) opens the collection directly with get_collection,
+    skipping the get-or-create probe; the first start creates it and writes
+    the marker.
+    """
+    if os.path.exists(ENGINE_META_PATH):
+        try:
+            with open(ENGINE_META_PATH, "rb") as f:
+                engine_meta = pickle.load(f)
+            if engine_meta.get("coll_name") == COLLECTION_NAME:
+                return db.get_collection(COLLECTION_NAME)
+        except Exception as e:
+            print(f"Warning: could not use {ENGINE_META_PATH} ({e}); falling back to get_or_create.")
+
+    collection = db.get_or_create_collection(COLLECTION_NAME)
+    with open(ENGINE_META_PATH, "wb") as f:
+        pickle.dump({"coll_name": COLLECTION_NAME, "dim": 1536}, f)
+    return collection
+
+
 def get_query_engine():
     """
     Loads the persisted ChromaDB index and sets up the RAG query engine.
@@ -28,10 +79,10 @@ def get_query_engine():
     print(f"Connecting to ChromaDB at: {CHROMA_DB_PATH} and collection: {COLLECTION_NAME}")
 
     # Initialize ChromaDB client
-    db = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    db = get_chroma_client()
 
     # Get the existing collection
-    chroma_collection = db.get_or_create_collection(COLLECTION_NAME)
+    chroma_collection = get_chroma_collection(db)
 
     # Configure the vector store
     vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
@@ -43,7 +94,8 @@ def get_query_engine():
     # We explicitly set 'api_base' to use your custom endpoint (aipipe.org).
     embed_model = OpenAIEmbedding(
         model="text-embedding-ada-002",
-        api_base=os.getenv("OPENAI_BASE_URL")
+        api_base=os.getenv("OPENAI_BASE_URL"),
+        http_client=http_client # Reuse the shared connection pool
     )
 
     # Configure the LLM for response generation
@@ -51,7 +103,8 @@ def get_query_engine():
     llm = OpenAI(
         model="gpt-3.5-turbo", # You can choose other models like "gpt-4" if you have access
         api_base=os.getenv("OPENAI_BASE_URL"),
-        temperature=0.1 # Lower temperature for more factual, less creative answers
+        temperature=0.1, # Lower temperature for more factual, less creative answers
+        http_client=http_client # Reuse the shared connection pool
     )
 
     # Load the index from the persisted storage